@@ -1,25 +1,287 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import os
 import sys
 import signal
-import gi
+import socket
 import json
-gi.require_version('Playerctl', '2.0')
-from gi.repository import Playerctl, GLib
+import time
 
-logger = logging.getLogger(__name__)
+# Loaded by load_gi() so that --client never pays for importing gi
+Playerctl = GLib = None
 
+logger = logging.getLogger(__name__)
 
-def write_output(text, player):
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                              'waybar-mediaplayer.sock')
+
+
+def load_gi(playerctl=True):
+    global Playerctl, GLib
+    import gi
+    from gi.repository import GLib
+    if playerctl:
+        gi.require_version('Playerctl', '2.0')
+        from gi.repository import Playerctl
+
+
+class CoalescingWriter:
+    """Write lines to a stream, dropping duplicates and collapsing bursts.
+
+    Lines pushed within `window_ms` of each other are merged so only the
+    last one is written once the window closes. A line equal to the one
+    last written is never repeated.
+    """
+
+    def __init__(self, window_ms, stream=sys.stdout):
+        self.window_ms = window_ms
+        self.stream = stream
+        self.last = None
+        self.pending = None
+        self.timer = None
+
+    def push(self, line):
+        self.pending = line
+        if self.window_ms <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = GLib.timeout_add(self.window_ms, self._on_timeout)
+
+    def flush(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        line, self.pending = self.pending, None
+        if line is None or line == self.last:
+            logger.debug('Skipping unchanged output')
+            return
+        self.last = line
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def _on_timeout(self):
+        self.timer = None
+        self.flush()
+        return GLib.SOURCE_REMOVE
+
+
+class PlayerState:
+    """Last known status and rendered track info of one managed player"""
+
+    __slots__ = ('name', 'status', 'text', 'track', 'seq', 'position', 'stamp',
+                 'length')
+
+    def __init__(self, name):
+        self.name = name
+        self.status = None
+        self.text = ''
+        self.track = None
+        self.seq = 0
+        # Position in microseconds as of the monotonic time `stamp`
+        self.position = 0
+        self.stamp = 0.0
+        self.length = 0
+
+    def elapsed(self):
+        """Current position, interpolated from the last one read while playing"""
+        position = self.position
+        if self.status == 'Playing':
+            position += int((time.monotonic() - self.stamp) * 1e6)
+        return min(position, self.length) if self.length else position
+
+
+class PlayerTable:
+    """Track every managed player and emit the one chosen by `policy`.
+
+    policy is one of:
+      playing - a playing player beats a paused one, then most recent
+      recent  - the player that changed most recently
+      order   - first player in `order`, then as for 'playing'
+
+    With a non-zero `interval` (seconds) the elapsed/total time of the
+    selected player is appended, refreshed by a timer that only runs
+    while that player is playing.
+    """
+
+    def __init__(self, policy='playing', order=(), interval=0):
+        self.policy = policy
+        self.order = list(order)
+        self.interval = interval
+        self.players = {}
+        self.selected = None
+        self.seq = 0
+        self.timer = None
+
+    def update(self, key, name, status, text, track=None):
+        """Store a player's status and text; True if status or track changed"""
+        state = self.players.get(key)
+        if state is None:
+            state = self.players[key] = PlayerState(name)
+        moved = state.status != status or state.track != track
+        state.track = track
+        if state.status == status and state.text == text:
+            return moved
+        if state.status != status:
+            state.position = state.elapsed()
+            state.stamp = time.monotonic()
+        state.status = status
+        state.text = text
+        self.seq += 1
+        state.seq = self.seq
+        self._select()
+        return moved
+
+    def set_position(self, key, name, position, length=None):
+        state = self.players.get(key)
+        if state is None:
+            state = self.players[key] = PlayerState(name)
+        state.position = position
+        state.stamp = time.monotonic()
+        if length is not None:
+            state.length = length
+        if state is self.selected:
+            write_output(state)
+
+    def remove(self, key):
+        if self.players.pop(key, None) is not None:
+            self._select()
+
+    def _rank(self, state):
+        playing = state.status == 'Playing'
+        if self.policy == 'recent':
+            return (state.seq,)
+        if self.policy == 'order':
+            pos = (self.order.index(state.name) if state.name in self.order
+                   else len(self.order))
+            return (-pos, playing, state.seq)
+        return (playing, state.seq)
+
+    def _select(self):
+        if not self.players:
+            self.selected = None
+            writer.push('')
+        else:
+            self.selected = max(self.players.values(), key=self._rank)
+            write_output(self.selected)
+        self._arm_timer()
+
+    def _arm_timer(self):
+        ticking = (self.interval > 0 and self.selected is not None
+                   and self.selected.status == 'Playing')
+        if ticking and self.timer is None:
+            self.timer = GLib.timeout_add_seconds(self.interval, self._on_tick)
+        elif not ticking and self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+    def _on_tick(self):
+        write_output(self.selected)
+        return GLib.SOURCE_CONTINUE
+
+
+class Broadcaster:
+    """Stream-like sink that fans lines out to clients on a Unix socket
+
+    Sends never block the main loop: a client whose socket buffer is full
+    is dropped and gets the latest line again when it reconnects.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.clients = {}  # socket -> GLib source watching it for hangups
+        self.last = ''
+        self.server = self._listen(path)
+        GLib.io_add_watch(self.server.fileno(), GLib.IO_IN, self._on_accept)
+
+    @staticmethod
+    def _listen(path):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)  # stale socket from a previous daemon
+            else:
+                probe.close()
+                sys.exit('Another instance is listening on ' + path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        return server
+
+    def _on_accept(self, fd, condition):
+        conn, _ = self.server.accept()
+        conn.setblocking(False)
+        logger.info('Client connected')
+        self.clients[conn] = GLib.io_add_watch(
+            conn.fileno(), GLib.IO_HUP | GLib.IO_ERR,
+            lambda fd, condition: self._drop(conn, 'Client disconnected'))
+        if self.last:
+            self._send(conn, self.last.encode())
+        return True
+
+    def _drop(self, conn, reason):
+        source = self.clients.pop(conn, None)
+        if source is not None:
+            logger.info(reason)
+            GLib.source_remove(source)
+            conn.close()
+        return False
+
+    def _send(self, conn, data):
+        try:
+            sent = conn.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(conn, 'Client disconnected')
+            return
+        if sent < len(data):
+            self._drop(conn, 'Client is not keeping up, dropped it')
+
+    def write(self, data):
+        self.last = data
+        data = data.encode()
+        for conn in list(self.clients):
+            self._send(conn, data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        for conn in list(self.clients):
+            self._drop(conn, 'Closing client')
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+writer = CoalescingWriter(0)
+table = PlayerTable()
+
+
+def format_time(us):
+    minutes, seconds = divmod(us // 1000000, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+    return '{}:{:02}'.format(minutes, seconds)
+
+
+def write_output(state):
     logger.info('Writing output')
 
-    output = {'text': text,
-              'class': 'custom-' + player.props.player_name,
-              'alt': player.props.player_name}
+    text = state.text
+    output = {'class': 'custom-' + state.name,
+              'alt': state.name}
+    if table.interval and state.length and text:
+        elapsed = state.elapsed()
+        text += ' {}/{}'.format(format_time(elapsed), format_time(state.length))
+        output['percentage'] = elapsed * 100 // state.length
+    output['text'] = text
 
-    sys.stdout.write(json.dumps(output) + '\n')
-    sys.stdout.flush()
+    writer.push(json.dumps(output))
 
 
 def on_play(player, status, manager):
@@ -43,7 +305,32 @@ def on_metadata(player, metadata, manager):
 
     if player.props.status != 'Playing' and track_info:
         track_info = ' ' + track_info
-    write_output(track_info, player)
+    track = (metadata['mpris:trackid']
+             if 'mpris:trackid' in metadata.keys() else None)
+    moved = table.update(player.props.player_instance, player.props.player_name,
+                         player.props.status, track_info, track)
+    # Metadata comes in bursts; the position only needs reading again when
+    # playback starts/stops or the track changes
+    if moved and table.interval:
+        length = (metadata['mpris:length']
+                  if 'mpris:length' in metadata.keys() else 0)
+        sync_position(player, length)
+
+
+def sync_position(player, length=None):
+    # A single D-Bus read; progress is interpolated locally from here
+    try:
+        position = player.props.position
+    except GLib.Error:
+        position = 0
+    table.set_position(player.props.player_instance, player.props.player_name,
+                       position, length)
+
+
+def on_seeked(player, position, manager):
+    logger.info('Player seeked')
+    table.set_position(player.props.player_instance, player.props.player_name,
+                       position)
 
 
 def on_player_appeared(manager, player, selected_player=None):
@@ -55,8 +342,7 @@ def on_player_appeared(manager, player, selected_player=None):
 
 def on_player_vanished(manager, player):
     logger.info('Player has vanished')
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    table.remove(player.props.player_instance)
 
 
 def init_player(manager, name):
@@ -64,19 +350,43 @@ def init_player(manager, name):
     player = Playerctl.Player.new_from_name(name)
     player.connect('playback-status', on_play, manager)
     player.connect('metadata', on_metadata, manager)
+    player.connect('seeked', on_seeked, manager)
     manager.manage_player(player)
     on_metadata(player, player.props.metadata, manager)
 
 
+def run_client(path):
+    """Relay lines from a mediaplayer daemon to stdout, reconnecting as needed"""
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.connect(path)
+                logger.info('Connected to {}'.format(path))
+                for line in conn.makefile('r'):
+                    if not line.endswith('\n'):
+                        break  # cut off when the daemon dropped us
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+        except OSError as e:
+            logger.debug('Daemon unavailable: {}'.format(e))
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+        time.sleep(2)
+
+
 def signal_handler(sig, frame):
     logger.debug('Received signal to stop, exiting')
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    writer.flush()
+    if isinstance(writer.stream, Broadcaster):
+        writer.stream.close()
+    else:
+        sys.stdout.write('\n')
+        sys.stdout.flush()
     # loop.quit()
     sys.exit(0)
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser()
 
     # Increase verbosity with every occurance of -v
@@ -85,32 +395,41 @@ def parse_arguments():
     # Define for which player we're listening
     parser.add_argument('--player')
 
-    return parser.parse_args()
+    # Collapse bursts of updates arriving within this many milliseconds
+    parser.add_argument('--coalesce-ms', type=int, default=150)
 
+    # Which player to show when several are active
+    parser.add_argument('--priority', choices=['playing', 'recent', 'order'],
+                        default='playing')
 
-def main():
-    arguments = parse_arguments()
+    # Comma separated player names for --priority order
+    parser.add_argument('--order', default='')
 
-    # Initialize logging
-    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG,
-                        format='%(name)s %(levelname)s %(message)s')
+    # Append elapsed/total time, refreshed every N seconds while playing
+    parser.add_argument('--progress-interval', type=int, default=0)
 
-    # Logging is set by default to WARN and higher.
-    # With every occurrence of -v it's lowered by one
-    logger.setLevel(max((3 - arguments.verbose) * 10, 0))
+    # Share one PlayerManager between bars: a single --daemon serves any
+    # number of --client processes over a Unix socket
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--daemon', action='store_true')
+    mode.add_argument('--client', action='store_true')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
 
-    # Log the sent command line arguments
-    logger.debug('Arguments received {}'.format(vars(arguments)))
+    return parser.parse_args(argv)
 
+
+def start(arguments, stream):
+    """Set up the PlayerManager writing to stream; the caller runs the GLib loop"""
+    global writer, table
+    writer = CoalescingWriter(arguments.coalesce_ms, stream)
+    table = PlayerTable(arguments.priority,
+                        [name for name in arguments.order.split(',') if name],
+                        arguments.progress_interval)
     manager = Playerctl.PlayerManager()
-    loop = GLib.MainLoop()
 
     manager.connect('name-appeared', lambda *args: on_player_appeared(*args, arguments.player))
     manager.connect('player-vanished', on_player_vanished)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
     for player in manager.props.player_names:
         if arguments.player is not None and arguments.player != player.name:
             logger.debug('{player} is not the filtered player, skipping it'
@@ -120,7 +439,34 @@ def main():
 
         init_player(manager, player)
 
-    loop.run()
+    return manager
+
+
+def main():
+    arguments = parse_arguments()
+
+    # Initialize logging
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG,
+                        format='%(name)s %(levelname)s %(message)s')
+
+    # Logging is set by default to WARN and higher.
+    # With every occurrence of -v it's lowered by one
+    logger.setLevel(max((3 - arguments.verbose) * 10, 0))
+
+    # Log the sent command line arguments
+    logger.debug('Arguments received {}'.format(vars(arguments)))
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    if arguments.client:
+        run_client(arguments.socket)
+        return
+
+    load_gi()
+    stream = Broadcaster(arguments.socket) if arguments.daemon else sys.stdout
+    start(arguments, stream)
+    GLib.MainLoop().run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,211 @@
+# mediaplayer_test.py
+#
+# Player selection, output dedup and the daemon's client handling. These
+# only need GLib for timers and fd watches, so a small stand-in that
+# records sources (and fires them on request) replaces gi here.
+
+import io
+import json
+import socket
+
+import pytest
+
+import mediaplayer
+
+
+class FakeGLib:
+    SOURCE_REMOVE = False
+    SOURCE_CONTINUE = True
+    IO_IN, IO_ERR, IO_HUP = 1, 8, 16
+
+    def __init__(self):
+        self.sources = {}
+        self.last_id = 0
+
+    def timeout_add(self, interval, callback):
+        self.last_id += 1
+        self.sources[self.last_id] = callback
+        return self.last_id
+
+    timeout_add_seconds = timeout_add
+
+    def io_add_watch(self, fd, condition, callback):
+        return self.timeout_add(0, lambda: callback(fd, condition))
+
+    def source_remove(self, source):
+        del self.sources[source]
+
+    def fire(self, source):
+        # A callback may remove its own source, as GLib allows
+        if not self.sources[source]():
+            self.sources.pop(source, None)
+
+
+@pytest.fixture
+def glib(monkeypatch):
+    fake = FakeGLib()
+    monkeypatch.setattr(mediaplayer, 'GLib', fake)
+    return fake
+
+
+@pytest.fixture
+def stream(monkeypatch, glib):
+    out = io.StringIO()
+    monkeypatch.setattr(mediaplayer, 'writer', mediaplayer.CoalescingWriter(0, out))
+    return out
+
+
+def texts(stream):
+    return [json.loads(line)['text'] if line else '' for line in
+            stream.getvalue().splitlines()]
+
+
+def use_table(monkeypatch, *args, **kwargs):
+    table = mediaplayer.PlayerTable(*args, **kwargs)
+    monkeypatch.setattr(mediaplayer, 'table', table)
+    return table
+
+
+def test_writer_drops_duplicates(glib):
+    out = io.StringIO()
+    writer = mediaplayer.CoalescingWriter(0, out)
+    for line in ['a', 'a', 'b', 'b', 'a']:
+        writer.push(line)
+    assert out.getvalue() == 'a\nb\na\n'
+
+
+def test_writer_collapses_bursts(glib):
+    out = io.StringIO()
+    writer = mediaplayer.CoalescingWriter(150, out)
+    for line in ['a', 'b', 'c']:
+        writer.push(line)
+    assert out.getvalue() == ''
+    assert len(glib.sources) == 1  # one timer for the whole burst
+
+    glib.fire(writer.timer)
+    assert out.getvalue() == 'c\n'
+    assert glib.sources == {}
+
+
+def test_playing_policy_prefers_playing_then_recent(monkeypatch, stream):
+    table = use_table(monkeypatch, 'playing')
+    table.update('mpv', 'mpv', 'Playing', 'song')
+    table.update('spotify', 'spotify', 'Paused', 'podcast')
+    assert table.selected.name == 'mpv'
+
+    table.update('mpv', 'mpv', 'Paused', 'song')
+    assert table.selected.name == 'mpv'  # both paused: most recent change wins
+    table.update('spotify', 'spotify', 'Playing', 'podcast')
+    assert table.selected.name == 'spotify'
+
+
+def test_recent_policy_follows_the_last_change(monkeypatch, stream):
+    table = use_table(monkeypatch, 'recent')
+    table.update('mpv', 'mpv', 'Playing', 'song')
+    table.update('spotify', 'spotify', 'Paused', 'podcast')
+    assert table.selected.name == 'spotify'
+
+
+def test_order_policy_ranks_listed_players_first(monkeypatch, stream):
+    table = use_table(monkeypatch, 'order', order=['spotify', 'mpv'])
+    table.update('vlc', 'vlc', 'Playing', 'video')
+    table.update('mpv', 'mpv', 'Paused', 'song')
+    assert table.selected.name == 'mpv'
+    table.update('spotify', 'spotify', 'Paused', 'podcast')
+    assert table.selected.name == 'spotify'
+
+    table.remove('spotify')
+    assert table.selected.name == 'mpv'
+
+
+def test_unchanged_updates_are_not_written(monkeypatch, stream):
+    table = use_table(monkeypatch)
+    table.update('mpv', 'mpv', 'Playing', 'song')
+    table.update('mpv', 'mpv', 'Playing', 'song')
+    table.update('spotify', 'spotify', 'Paused', 'podcast')  # mpv stays selected
+    assert texts(stream) == ['song']
+
+    table.remove('mpv')
+    table.remove('spotify')
+    assert texts(stream) == ['song', 'podcast', '']
+
+
+def test_progress_timer_runs_only_while_playing(monkeypatch, stream, glib):
+    table = use_table(monkeypatch, interval=1)
+    table.update('mpv', 'mpv', 'Paused', 'song')
+    assert table.timer is None
+
+    table.update('mpv', 'mpv', 'Playing', 'song')
+    assert table.timer in glib.sources
+    table.set_position('mpv', 'mpv', 61_000_000, length=180_000_000)
+    assert texts(stream)[-1] == 'song 1:01/3:00'
+
+    table.update('mpv', 'mpv', 'Paused', 'song')
+    assert table.timer is None
+    assert glib.sources == {}
+
+
+def test_broadcaster_replays_the_last_line_and_drops_clients(glib, tmp_path):
+    broadcaster = mediaplayer.Broadcaster(str(tmp_path / 'media.sock'))
+    accept = next(iter(glib.sources))
+    broadcaster.write('{"text": "song"}\n')
+
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(broadcaster.path)
+        glib.fire(accept)
+        assert client.recv(100) == b'{"text": "song"}\n'
+        (hangup,) = broadcaster.clients.values()
+
+    glib.fire(hangup)  # as GLib would on IO_HUP
+    assert broadcaster.clients == {}
+    assert list(glib.sources) == [accept]
+
+    with socket.socket(socket.AF_UNIX) as slow:
+        slow.connect(broadcaster.path)
+        glib.fire(accept)
+        for _ in range(1000):  # fills the socket buffer without reading
+            broadcaster.write('x' * 1000 + '\n')
+        assert broadcaster.clients == {}
+    broadcaster.close()
+
+
+class FakePlayer:
+    """Just enough of Playerctl.Player for on_metadata, counting D-Bus reads"""
+
+    def __init__(self, status, title):
+        self.reads = 0
+        self.props = self
+        self.player_name = self.player_instance = 'mpv'
+        self.status = status
+        self.metadata = {'mpris:trackid': '/track/1', 'mpris:length': 180_000_000}
+        self.title = title
+
+    @property
+    def position(self):
+        self.reads += 1
+        return 5_000_000
+
+    def get_artist(self):
+        return ''
+
+    def get_title(self):
+        return self.title
+
+
+def test_metadata_bursts_read_the_position_once(monkeypatch, stream):
+    use_table(monkeypatch, interval=1)
+    player = FakePlayer('Playing', 'song')
+    for _ in range(5):
+        mediaplayer.on_metadata(player, player.metadata, None)
+    assert player.reads == 1
+    assert texts(stream)[-1] == 'song 0:05/3:00'
+
+    player.title = 'song (live)'  # same track, new text
+    mediaplayer.on_metadata(player, player.metadata, None)
+    assert player.reads == 1
+
+    player.metadata = dict(player.metadata, **{'mpris:trackid': '/track/2'})
+    mediaplayer.on_metadata(player, player.metadata, None)
+    player.status = 'Paused'
+    mediaplayer.on_metadata(player, player.metadata, None)
+    assert player.reads == 3
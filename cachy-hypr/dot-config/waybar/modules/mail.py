@@ -1,42 +1,562 @@
 #!/usr/bin/python
 
-import os
+import argparse
+import errno
+import fcntl
 import imaplib
+import json
+import os
+import re
+import select
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mailsecrets
 
-def getmails(username, password, server):
-    imap = imaplib.IMAP4_SSL(server, 993)
-    imap.login(username, password)
-    imap.select('INBOX')
-    ustatus, uresponse = imap.uid('search', None, 'UNSEEN')
-    if ustatus == 'OK':
-        unread_msg_nums = uresponse[0].split()
-    else:
-        unread_msg_nums = []
+# RFC 2177: re-issue IDLE before the server's 30 minute inactivity timeout
+IDLE_TIMEOUT = 29 * 60
+# Untagged responses that mean the mailbox changed, as opposed to keepalives
+# like "* OK Still here"
+CHANGE = re.compile(rb'\* \d+ (EXISTS|EXPUNGE|FETCH|RECENT)\b', re.I)
+BACKOFF_MIN = 5
+BACKOFF_MAX = 300
+# Bounds connecting and every command, so a dead server can't hang a thread
+CONNECT_TIMEOUT = 30
+# Push mode re-checks this often on servers without IDLE
+POLL_INTERVAL = 60
+# Reachability probes: connect timeout and how long a result is trusted
+PROBE_TIMEOUT = 1.0
+PROBE_TTL = 30
+# While backing off, how often to check whether the network changed
+NETWORK_CHECK = 2
+CACHE_FILE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'waybar-mail.json')
+
+
+class Account:
+    def __init__(self, server, username, password, port=993, ssl=True, name=None):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.port = port
+        self.ssl = ssl
+        self.name = name or username
+
+    @property
+    def key(self):
+        return '%s@%s:%d' % (self.username, self.server, self.port)
+
+
+def load_accounts(server=None, port=None, ssl=True):
+    """Accounts from mailsecrets.accounts, or the single server/username/password.
+
+    mailsecrets.accounts is a list of dicts with the Account arguments, e.g.
+    accounts = [{'name': 'work', 'server': ..., 'username': ..., 'password': ...}]
+    server/port/ssl override the single account, e.g. to use a local test server.
+    """
+    if server is None and hasattr(mailsecrets, 'accounts'):
+        return [Account(**a) for a in mailsecrets.accounts]
+    return [Account(server or mailsecrets.server, mailsecrets.username,
+                    mailsecrets.password, port or 993, ssl)]
+
+
+def connect(account):
+    imap_class = imaplib.IMAP4_SSL if account.ssl else imaplib.IMAP4
+    imap = imap_class(account.server, account.port, timeout=CONNECT_TIMEOUT)
+    imap.login(account.username, account.password)
+    # Servers may only advertise extensions like CONDSTORE once logged in
+    typ, data = imap.capability()
+    if typ == 'OK' and data[-1]:
+        imap.capabilities = tuple(data[-1].decode().upper().split())
+    return imap
+
+
+def select_inbox(imap):
+    """EXAMINE INBOX, enabling CONDSTORE so the reply carries HIGHESTMODSEQ"""
+    mailbox = 'INBOX (CONDSTORE)' if 'CONDSTORE' in imap.capabilities else 'INBOX'
+    typ, data = imap.select(mailbox, readonly=True)
+    if typ != 'OK':
+        raise imap.error('EXAMINE failed: %r' % data)
+
+
+def logout(imap):
+    try:
+        imap.logout()
+    except (OSError, imaplib.IMAP4.error):
+        pass
+
+
+class ConnectionPool:
+    """One reusable, logged in connection per account"""
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, account):
+        with self.lock:
+            imap = self.connections.pop(account, None)
+        if imap is not None:
+            try:
+                imap.noop()
+                return imap
+            except (OSError, imaplib.IMAP4.error):
+                logout(imap)
+        return connect(account)
+
+    def put(self, account, imap):
+        with self.lock:
+            self.connections[account] = imap
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for imap in connections.values():
+            logout(imap)
+
+
+class Cache:
+    """Last counts, HIGHESTMODSEQ and reachability per account, kept on disk.
+
+    Several bars may run mail.py at once; writes are serialized with a lock
+    file and merged into what is on disk, so no process drops another's.
+    """
 
-    fstatus, fresponse = imap.uid('search', None, 'FLAGGED')
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, account):
+        entry = self.entries.get(account.key, {})
+        return entry.get('mails'), entry.get('modseq')
+
+    def set(self, account, mails, modseq):
+        self._update(account, mails=mails, modseq=modseq)
+
+    def get_reachable(self, account, network):
+        """Cached probe result, or None if expired or the network changed"""
+        probe = self.entries.get(account.key, {}).get('probe')
+        if (probe is None or probe['network'] != network
+                or time.time() - probe['time'] > PROBE_TTL):
+            return None
+        return probe['ok']
+
+    def set_reachable(self, account, network, ok):
+        self._update(account, probe={'ok': ok, 'network': network,
+                                     'time': time.time()})
+
+    def _update(self, account, **fields):
+        with self.lock:
+            entry = self.entries.get(account.key, {})
+            if all(entry.get(k) == v for k, v in fields.items()):
+                return
+            self.entries[account.key] = dict(entry, **fields)
+            directory = os.path.dirname(self.path)
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(self.path + '.lock', 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    entries = self._load()
+                    entries[account.key] = dict(entries.get(account.key, {}), **fields)
+                    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                    try:
+                        with os.fdopen(fd, 'w') as f:
+                            json.dump(entries, f)
+                        os.replace(tmp, self.path)
+                    except OSError:
+                        os.unlink(tmp)
+                        raise
+                self.entries = entries
+            except OSError as e:
+                print('mail: cannot write %s: %s' % (self.path, e), file=sys.stderr)
+
+
+def status_counts(imap):
+    """Return (unseen, highestmodseq or None) for INBOX from a single STATUS"""
+    items = ('(UNSEEN HIGHESTMODSEQ)' if 'CONDSTORE' in imap.capabilities
+             else '(UNSEEN)')
+    typ, data = imap.status('INBOX', items)
+    if typ != 'OK':
+        raise imap.error('STATUS failed: %r' % data)
+    unseen = re.search(rb'UNSEEN (\d+)', data[0])
+    modseq = re.search(rb'HIGHESTMODSEQ (\d+)', data[0])
+    return (int(unseen.group(1)) if unseen else 0,
+            int(modseq.group(1)) if modseq else None)
+
+
+def selected_counts(imap):
+    """Return (unseen, highestmodseq or None) for the selected INBOX.
+
+    RFC 3501 6.3.10 rules out STATUS on the selected mailbox, so unseen is
+    searched for, and HIGHESTMODSEQ is only known from the SELECT reply.
+    """
+    _, data = imap.response('HIGHESTMODSEQ')
+    return count_matching(imap, 'UNSEEN'), int(data[-1]) if data[-1] else None
+
+
+def count_matching(imap, criteria):
+    if 'ESEARCH' in imap.capabilities:
+        # RFC 4731: only the count comes back, not every matching UID
+        imap.search(None, 'RETURN', '(COUNT)', criteria)
+        _, data = imap.response('ESEARCH')
+        count = re.search(rb'COUNT (\d+)', data[-1] or b'')
+        return int(count.group(1)) if count else 0
+
+    fstatus, fresponse = imap.uid('search', None, criteria)
     if fstatus == 'OK':
-        flagged_msg_nums = fresponse[0].split()
-    else:
-        flagged_msg_nums = []
+        return len(fresponse[0].split())
+    return 0
 
-    return [len(unread_msg_nums), len(flagged_msg_nums)]
 
-ping = os.system("ping " + mailsecrets.server + " -c1 > /dev/null 2>&1")
-if ping == 0:
-    mails = getmails(mailsecrets.username, mailsecrets.password, mailsecrets.server)
-    text = ''
-    alt = ''
+def countmails(imap, account, cache):
+    """Return [unread, flagged], skipping the search if HIGHESTMODSEQ is unchanged"""
+    selected = imap.state == 'SELECTED'
+    unread, modseq = selected_counts(imap) if selected else status_counts(imap)
+    cached, cached_modseq = cache.get(account)
+    if modseq is not None and modseq == cached_modseq:
+        return cached
 
-    if mails[0] > 0:
-        text = alt = str(mails[0])
-        if mails[1] > 0:
-            alt = str(mails[1]) + "  " + alt
+    if selected:
+        flagged = count_matching(imap, 'FLAGGED')
     else:
+        imap.select('INBOX', readonly=True)
+        try:
+            flagged = count_matching(imap, 'FLAGGED')
+        finally:
+            imap.close()
+
+    mails = [unread, flagged]
+    cache.set(account, mails, modseq)
+    return mails
+
+
+def network_id():
+    """Fingerprint of the default routes; None when there are none (offline)"""
+    routes = []
+    try:
+        with open('/proc/net/route') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[1] == '00000000':
+                    routes.append(fields[0] + ':' + fields[2])
+    except OSError:
+        return 'unknown'
+    try:
+        with open('/proc/net/ipv6_route') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == '0' * 32 and fields[1] == '00' and fields[9] != 'lo':
+                    routes.append(fields[9] + ':' + fields[4])
+    except OSError:
+        pass
+    return ','.join(sorted(routes)) or None
+
+
+def probe(server, port, timeout=PROBE_TIMEOUT):
+    """Non-blocking TCP connect to server:port; True if it completes in time"""
+    try:
+        addresses = socket.getaddrinfo(server, port, type=socket.SOCK_STREAM)
+    except OSError:
+        return False
+
+    deadline = time.monotonic() + timeout
+    for family, type_, proto, _, address in addresses:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        with socket.socket(family, type_, proto) as sock:
+            sock.setblocking(False)
+            if sock.connect_ex(address) not in (0, errno.EINPROGRESS):
+                continue
+            _, writable, _ = select.select([], [sock], [], remaining)
+            if writable and not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                return True
+    return False
+
+
+def reachable(account, cache):
+    network = network_id()
+    local = account.server in ('localhost', '::1') or account.server.startswith('127.')
+    if network is None and not local:
+        return False
+
+    ok = cache.get_reachable(account, network)
+    if ok is None:
+        ok = probe(account.server, account.port)
+        cache.set_reachable(account, network, ok)
+    return ok
+
+
+def getmails(account, pool, cache):
+    """Counts for one account using a pooled connection, or None on failure"""
+    if not reachable(account, cache):
+        print('mail: %s: %s unreachable' % (account.name, account.server),
+              file=sys.stderr)
+        return None
+    imap = None
+    try:
+        imap = pool.get(account)
+        mails = countmails(imap, account, cache)
+    except (OSError, imaplib.IMAP4.error) as e:
+        print('mail: %s: %s' % (account.name, e), file=sys.stderr)
+        if imap is not None:
+            logout(imap)
+        if isinstance(e, OSError):
+            cache.set_reachable(account, network_id(), False)
+        return None
+    pool.put(account, imap)
+    return mails
+
+
+def check_all(accounts, pool, executor, cache):
+    """Check every account concurrently; returns [(account, mails or None)]"""
+    return list(zip(accounts,
+                    executor.map(lambda a: getmails(a, pool, cache), accounts)))
+
+
+def format_output(results):
+    """Return the waybar JSON line for [(account, mails)], or None to hide the module"""
+    unread = sum(mails[0] for _, mails in results if mails)
+    flagged = sum(mails[1] for _, mails in results if mails)
+    if unread <= 0:
+        return None
+
+    text = alt = str(unread)
+    if flagged > 0:
+        alt = str(flagged) + "  " + alt
+
+    tooltip = '\n'.join(
+        '%s: %d unread, %d flagged' % (account.name, mails[0], mails[1])
+        if mails else '%s: unavailable' % account.name
+        for account, mails in results)
+
+    return json.dumps({'text': text, 'alt': alt, 'tooltip': tooltip},
+                      ensure_ascii=False)
+
+
+def readable(imap):
+    """True if imap has data that can be read without waiting on the socket"""
+    # Lines may already sit in imaplib's buffered file, or decrypted in the
+    # SSL layer, where select() can't see them; peek without blocking
+    timeout = imap.sock.gettimeout()
+    imap.sock.setblocking(False)
+    try:
+        return bool(imap.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        imap.sock.settimeout(timeout)
+
+
+def idle(imap, timeout=IDLE_TIMEOUT):
+    """Block in IMAP IDLE until the server reports a change or timeout expires.
+
+    Returns True if an untagged update (EXISTS, EXPUNGE, FETCH, RECENT) was
+    received, False on timeout.
+    """
+    tag = imap._new_tag()
+    imap.send(tag + b' IDLE\r\n')
+    line = imap.readline()
+    if not line.startswith(b'+'):
+        raise imap.error('IDLE not accepted: %r' % line)
+
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not readable(imap):
+            ready, _, _ = select.select([imap.sock], [], [], remaining)
+            if not ready:
+                break
+        line = imap.readline()
+        if not line:
+            raise imap.abort('connection closed during IDLE')
+        changed = bool(CHANGE.match(line))
+
+    imap.send(b'DONE\r\n')
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imap.abort('connection closed during IDLE')
+        if line.startswith(tag):
+            if not line[len(tag):].strip().startswith(b'OK'):
+                raise imap.error('IDLE failed: %r' % line)
+            return changed
+        changed = changed or bool(CHANGE.match(line))
+
+
+PENDING = object()
+
+
+class Output:
+    """Combine per-account counts and print a line only when it changes.
+
+    Nothing is printed until every account has been checked once, unless
+    a cache is given: then the cached counts are printed right away.
+    """
+
+    def __init__(self, accounts, cache=None, stream=sys.stdout):
+        self.results = {account: PENDING for account in accounts}
+        self.stream = stream
+        self.last = None
+        self.lock = threading.Lock()
+        if cache is not None:
+            cached = [(account, cache.get(account)[0]) for account in accounts]
+            if all(mails is not None for _, mails in cached):
+                self.emit(format_output(cached))
+
+    def update(self, results):
+        with self.lock:
+            self.results.update(results)
+            if PENDING not in self.results.values():
+                self.emit(format_output(list(self.results.items())))
+
+    def emit(self, line):
+        if line == self.last:
+            return
+        self.last = line
+        self.stream.write((line or '') + '\n')
+        self.stream.flush()
+
+
+def backoff_sleep(seconds):
+    """Sleep for seconds, returning True early if network_id() changes"""
+    network = network_id()
+    deadline = time.monotonic() + seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(NETWORK_CHECK, remaining))
+        if network_id() != network:
+            return True
+
+
+def push_account(account, output, cache, interval=POLL_INTERVAL):
+    """Keep one connection open for account and report every change.
+
+    Servers without IDLE are re-checked every interval seconds instead.
+    """
+    backoff = BACKOFF_MIN
+    while True:
+        try:
+            if not reachable(account, cache):
+                raise OSError('%s unreachable' % account.server)
+            imap = connect(account)
+        except (OSError, imaplib.IMAP4.error) as e:
+            print('mail: %s: connect failed: %s' % (account.name, e), file=sys.stderr)
+            output.update({account: None})
+            # A new network (e.g. wifi came back) is worth retrying right away
+            if backoff_sleep(backoff):
+                backoff = BACKOFF_MIN
+            else:
+                backoff = min(backoff * 2, BACKOFF_MAX)
+            continue
+
+        backoff = BACKOFF_MIN
+        try:
+            select_inbox(imap)
+            can_idle = 'IDLE' in imap.capabilities
+            if not can_idle:
+                print('mail: %s: no IDLE support, checking every %ds'
+                      % (account.name, interval), file=sys.stderr)
+            while True:
+                output.update({account: countmails(imap, account, cache)})
+                if can_idle:
+                    idle(imap)
+                else:
+                    time.sleep(interval)
+        except (OSError, imaplib.IMAP4.error) as e:
+            print('mail: %s: connection lost: %s' % (account.name, e), file=sys.stderr)
+        finally:
+            logout(imap)
+        backoff_sleep(backoff)
+
+
+def push(accounts, stream=sys.stdout, interval=POLL_INTERVAL):
+    """IDLE on every account in its own thread"""
+    cache = Cache()
+    output = Output(accounts, cache, stream)
+    threads = [threading.Thread(target=push_account,
+                                args=(account, output, cache, interval),
+                                daemon=True)
+               for account in accounts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def watch(accounts, interval, stream=sys.stdout):
+    """Check all accounts every interval seconds over pooled connections"""
+    cache = Cache()
+    output = Output(accounts, cache, stream)
+    pool = ConnectionPool()
+    with ThreadPoolExecutor(max_workers=max(len(accounts), 1)) as executor:
+        try:
+            while True:
+                output.update(check_all(accounts, pool, executor, cache))
+                time.sleep(interval)
+        finally:
+            pool.close()
+
+
+def poll(accounts):
+    pool = ConnectionPool()
+    with ThreadPoolExecutor(max_workers=max(len(accounts), 1)) as executor:
+        try:
+            line = format_output(check_all(accounts, pool, executor, Cache()))
+        finally:
+            pool.close()
+    if line is None:
         exit(1)
+    print(line)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser()
+
+    # Keep one connection per account open and wait for changes with IMAP IDLE
+    parser.add_argument('--push', action='store_true')
+
+    # Stay resident and re-check every N seconds over pooled connections
+    # (with --push: only for servers without IDLE)
+    parser.add_argument('--interval', type=int, default=0)
+
+    # Override mailsecrets.server, e.g. to point at a local test server
+    parser.add_argument('--server')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--no-ssl', dest='ssl', action='store_false')
+
+    return parser.parse_args(argv)
+
+
+def main():
+    arguments = parse_arguments()
+    accounts = load_accounts(arguments.server, arguments.port, arguments.ssl)
+    if arguments.push:
+        push(accounts, interval=arguments.interval or POLL_INTERVAL)
+    elif arguments.interval > 0:
+        watch(accounts, arguments.interval)
+    else:
+        poll(accounts)
 
-    print('{"text":"' + text + '", "alt": "' + alt + '"}')
 
-else:
-    exit(1)
+if __name__ == '__main__':
+    main()
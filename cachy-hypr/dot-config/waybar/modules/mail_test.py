@@ -0,0 +1,200 @@
+# mail_test.py
+#
+# Drives mail.py against a small in-process IMAP server, so IDLE handling
+# and the HIGHESTMODSEQ shortcut can be checked without a real account.
+
+import imaplib
+import io
+import itertools
+import socketserver
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+# mail.py reads credentials at import time; tests pass accounts explicitly
+sys.modules.setdefault('mailsecrets', types.ModuleType('mailsecrets'))
+
+import mail  # noqa: E402
+
+
+class FakeIMAP(socketserver.StreamRequestHandler):
+    """Answers the handful of commands mail.py sends, logging each of them"""
+
+    def handle(self):
+        state = self.server.state
+        caps = state['caps']
+        self.send('* OK ready')
+        for line in self.rfile:
+            tag, command, *args = line.decode().split()
+            command = command.upper()
+            state['log'].append(command)
+            if command == 'CAPABILITY':
+                self.send('* CAPABILITY ' + caps)
+            elif command == 'LOGIN':
+                caps += state['login_caps']
+            elif command == 'STATUS':
+                modseq = ' HIGHESTMODSEQ %d' % state['modseq'] if 'CONDSTORE' in caps else ''
+                self.send('* STATUS INBOX (UNSEEN %d%s)' % (state['unseen'], modseq))
+            elif command in ('SELECT', 'EXAMINE'):
+                self.send('* 5 EXISTS')
+                if '(CONDSTORE)' in args:
+                    self.send('* OK [HIGHESTMODSEQ %d] ok' % state['modseq'])
+            elif command in ('SEARCH', 'UID'):
+                count = state['unseen' if args[-1] == 'UNSEEN' else 'flagged']
+                self.send('* SEARCH ' + ' '.join(['1'] * count))
+            elif command == 'IDLE':
+                # Untagged lines go out in the same write as the continuation
+                self.send('+ idling', *state['idle'])
+                self.rfile.readline()  # DONE
+            elif command == 'LOGOUT':
+                self.send('* BYE')
+            self.send(tag + ' OK done')
+
+    def send(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+
+
+@pytest.fixture
+def server():
+    srv = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeIMAP)
+    srv.daemon_threads = True
+    srv.state = {'caps': 'IMAP4rev1 IDLE', 'login_caps': ' CONDSTORE', 'unseen': 2,
+                 'flagged': 1, 'modseq': 7, 'idle': [], 'log': []}
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def account(server):
+    return mail.Account('127.0.0.1', 'user', 'secret', server.server_address[1],
+                        ssl=False, name='test')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return mail.Cache(str(tmp_path / 'mail.json'))
+
+
+def test_connect_refreshes_capabilities_after_login(account):
+    imap = mail.connect(account)
+    assert 'CONDSTORE' in imap.capabilities
+    mail.logout(imap)
+
+
+def test_idle_reports_changes(server, account):
+    imap = mail.connect(account)
+    imap.select('INBOX', readonly=True)
+
+    assert mail.idle(imap, timeout=0.2) is False
+    server.state['idle'] = ['* 6 EXISTS']
+    start = time.monotonic()
+    assert mail.idle(imap, timeout=5) is True
+    assert time.monotonic() - start < 1  # seen in imaplib's buffer, not select()
+    imap.noop()  # the connection is usable again after DONE
+    mail.logout(imap)
+
+
+def test_idle_ignores_keepalives(server, account):
+    imap = mail.connect(account)
+    imap.select('INBOX', readonly=True)
+
+    server.state['idle'] = ['* OK Still here']
+    assert mail.idle(imap, timeout=0.3) is False
+    server.state['idle'] = ['* OK Still here', '* 2 FETCH (FLAGS (\\Seen))']
+    assert mail.idle(imap, timeout=5) is True
+    mail.logout(imap)
+
+
+def test_countmails_skips_search_when_modseq_is_unchanged(server, account, cache):
+    imap = mail.connect(account)
+    assert mail.countmails(imap, account, cache) == [2, 1]
+    searches = server.state['log'].count('UID')
+
+    server.state['flagged'] = 3  # unnoticed while HIGHESTMODSEQ stays put
+    assert mail.countmails(imap, account, cache) == [2, 1]
+    assert server.state['log'].count('UID') == searches
+
+    server.state['modseq'] += 1
+    assert mail.countmails(imap, account, cache) == [2, 3]
+    mail.logout(imap)
+
+
+def test_countmails_searches_the_selected_mailbox(server, account, cache):
+    imap = mail.connect(account)
+    mail.select_inbox(imap)
+    assert mail.countmails(imap, account, cache) == [2, 1]
+
+    # Selecting again with an unchanged HIGHESTMODSEQ skips the FLAGGED search
+    mail.select_inbox(imap)
+    del server.state['log'][:]
+    assert mail.countmails(imap, account, cache) == [2, 1]
+    assert server.state['log'] == ['UID']
+
+    # Later counts on the same selection can't know the modseq and search again
+    server.state['unseen'] = 4
+    assert mail.countmails(imap, account, cache) == [4, 1]
+    assert 'STATUS' not in server.state['log']
+    mail.logout(imap)
+
+
+def test_push_polls_servers_without_idle(server, account, cache):
+    server.state['caps'], server.state['login_caps'] = 'IMAP4rev1', ''
+    stream = io.StringIO()
+    output = mail.Output([account], stream=stream)
+    threading.Thread(target=mail.push_account,
+                     args=(account, output, cache, 0.05), daemon=True).start()
+
+    deadline = time.monotonic() + 5
+    while server.state['log'].count('UID') < 6 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert server.state['log'].count('UID') >= 6
+    assert 'IDLE' not in server.state['log']
+    assert 'STATUS' not in server.state['log']
+    assert '"text": "2"' in stream.getvalue()
+
+
+def test_backoff_ends_when_the_network_changes(monkeypatch):
+    networks = itertools.chain(['wlan0:0101A8C0', 'wlan0:0101A8C0'],
+                               itertools.repeat('eth0:0100000A'))
+    monkeypatch.setattr(mail, 'network_id', lambda: next(networks))
+    monkeypatch.setattr(mail, 'NETWORK_CHECK', 0.01)
+
+    start = time.monotonic()
+    assert mail.backoff_sleep(5) is True
+    assert time.monotonic() - start < 1
+    assert mail.backoff_sleep(0.05) is False
+
+
+def test_failed_check_logs_out(server, account, cache, monkeypatch):
+    def fail(imap, account, cache):
+        raise imaplib.IMAP4.error('STATUS failed')
+
+    monkeypatch.setattr(mail, 'countmails', fail)
+    pool = mail.ConnectionPool()
+    assert mail.getmails(account, pool, cache) is None
+    assert pool.connections == {}
+    assert 'LOGOUT' in server.state['log']
+
+
+def test_cache_writers_merge_instead_of_overwriting(tmp_path):
+    path = str(tmp_path / 'mail.json')
+    accounts = [mail.Account('imap.example.org', 'user%d' % i, '') for i in range(8)]
+    # One Cache per bar process, each with its own (stale) snapshot
+    caches = [mail.Cache(path) for _ in accounts]
+    threads = [threading.Thread(target=cache.set, args=(account, [i, 0], i))
+               for i, (cache, account) in enumerate(zip(caches, accounts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    merged = mail.Cache(path)
+    assert [merged.get(account) for account in accounts] == [
+        ([i, 0], i) for i in range(len(accounts))]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['mail.json', 'mail.json.lock']
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Host several waybar custom modules in one process.
+
+    runner.py serve [--modules mediaplayer,mail]
+    runner.py client mediaplayer
+
+`serve` runs every module in one process and publishes each module's
+JSON lines on its own Unix socket. mediaplayer runs on the GLib main
+loop; mail keeps its own blocking IMAP loop in a thread and hands only
+its output lines to the main loop. A module that fails to start is
+logged and skipped. `client` relays one of those sockets to stdout and is
+what waybar's "exec" should point at.
+"""
+import argparse
+import logging
+import os
+import shlex
+import signal
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mediaplayer  # noqa: E402 (imports gi lazily)
+
+logger = logging.getLogger(__name__)
+
+SOCKET_DIR = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                          'waybar-modules')
+
+
+def socket_path(name):
+    return os.path.join(SOCKET_DIR, name + '.sock')
+
+
+class MainLoopStream:
+    """Stream that hands writes from worker threads over to the GLib main loop"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        mediaplayer.GLib.idle_add(self._write, data)
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+        return mediaplayer.GLib.SOURCE_REMOVE
+
+    def flush(self):
+        pass
+
+
+def start_mediaplayer(argv, stream):
+    arguments = mediaplayer.parse_arguments(argv)
+    mediaplayer.load_gi()
+    return mediaplayer.start(arguments, stream)
+
+
+def start_mail(argv, stream):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'modules'))
+    import mail
+
+    arguments = mail.parse_arguments(argv)
+    accounts = mail.load_accounts(arguments.server, arguments.port, arguments.ssl)
+    # A one-shot poll makes no sense in a resident process
+    interval = arguments.interval or mail.POLL_INTERVAL
+    if arguments.push:
+        target, args = mail.push, (accounts, MainLoopStream(stream), interval)
+    else:
+        target, args = mail.watch, (accounts, interval, MainLoopStream(stream))
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+MODULES = {
+    'mediaplayer': start_mediaplayer,
+    'mail': start_mail,
+}
+
+
+def serve(arguments):
+    mediaplayer.load_gi(playerctl=False)
+    os.makedirs(SOCKET_DIR, exist_ok=True)
+
+    broadcasters = []
+    # Keep each module's PlayerManager/thread referenced while the loop runs
+    handles = []
+    for name in arguments.modules.split(','):
+        if name not in MODULES:
+            sys.exit('Unknown module: {}'.format(name))
+        broadcaster = mediaplayer.Broadcaster(socket_path(name))
+        logger.info('Starting {} on {}'.format(name, broadcaster.path))
+        try:
+            argv = shlex.split(getattr(arguments, name + '_args'))
+            handles.append(MODULES[name](argv, broadcaster))
+        except (Exception, SystemExit) as e:
+            # e.g. no mailsecrets.py, or bad --mail-args; keep the others up
+            logger.error('Could not start {}: {!r}'.format(name, e))
+            broadcaster.close()
+            continue
+        broadcasters.append(broadcaster)
+    if not broadcasters:
+        sys.exit('No module could be started')
+
+    def stop(sig, frame):
+        logger.debug('Received signal to stop, exiting')
+        for broadcaster in broadcasters:
+            broadcaster.close()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    mediaplayer.GLib.MainLoop().run()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    s = sub.add_parser('serve')
+    s.add_argument('--modules', default=','.join(MODULES))
+    for name in MODULES:
+        s.add_argument('--{}-args'.format(name), default='',
+                       help='command line passed to the {} module'.format(name))
+
+    c = sub.add_parser('client')
+    c.add_argument('module', choices=list(MODULES))
+
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+
+    # Applies to the hosted modules' loggers too
+    logging.basicConfig(stream=sys.stderr,
+                        level=max((3 - arguments.verbose) * 10, 0),
+                        format='%(name)s %(levelname)s %(message)s')
+
+    if arguments.cmd == 'client':
+        signal.signal(signal.SIGINT, lambda *args: sys.exit(0))
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        mediaplayer.run_client(socket_path(arguments.module))
+    else:
+        serve(arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,125 +1,336 @@
 #!/usr/bin/env python3
-import sys, argparse, re
-from tree_sitter import Language, Parser
+"""usage: parse-nix.py {get,query,set,del} ...
 
-# Load nix grammar
-NIX_LANGUAGE = Language("build/my-languages.so", "nix")
-parser = Parser()
-parser.set_language(NIX_LANGUAGE)
+  get FILE EXPR          print the value at EXPR
+  query EXPR FILE...     print every match of EXPR with its concrete path
+  set FILE EXPR VALUE    replace every value at EXPR
+  del FILE EXPR          delete every binding or list element at EXPR
+
+EXPR is a path like services.openssh.enable, "quoted.key", ${expr} or
+list[0]; * matches any attribute and [*] any list element.
+"""
+import sys, functools, re
+
+
+@functools.cache
+def get_parser():
+    """Load the nix grammar on first use, so --help and bad arguments stay fast"""
+    from tree_sitter import Language, Parser
+
+    parser = Parser()
+    parser.set_language(Language("build/my-languages.so", "nix"))
+    return parser
 
 
 def parse_file(path):
     with open(path, "rb") as f:
         code = f.read()
-    tree = parser.parse(code)
+    tree = get_parser().parse(code)
     return code, tree
 
 
-def split_path(path):
-    """Split .foo.bar[0] into tokens ["foo", "bar", 0]"""
+class Wildcard:
+    """Placeholder token matching every attribute or list element"""
+
+    __slots__ = ("kind",)
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def __repr__(self):
+        return "*" if self.kind == "attr" else "[*]"
+
+
+ANY_ATTR = Wildcard("attr")
+ANY_INDEX = Wildcard("index")
+
+BARE_NAME = re.compile(r"[a-zA-Z0-9_'-]+")
+STRING_ESCAPE = re.compile(r"\\(.)")
+
+
+def _scan_quoted(expr, i):
+    """Return (name, end) for a "..." key starting at expr[i]"""
+    j = i + 1
+    while j < len(expr):
+        if expr[j] == "\\":
+            j += 2
+            continue
+        if expr[j] == '"':
+            return STRING_ESCAPE.sub(r"\1", expr[i + 1:j]), j + 1
+        j += 1
+    raise ValueError(f"unterminated quoted key at offset {i}")
+
+
+def _scan_interpolation(expr, i):
+    """Return (text, end) for a ${...} key starting at expr[i]"""
+    depth = 0
+    j = i + 1
+    while j < len(expr):
+        if expr[j] == '"':  # braces inside strings don't count
+            _, j = _scan_quoted(expr, j)
+            continue
+        if expr[j] == "{":
+            depth += 1
+        elif expr[j] == "}":
+            depth -= 1
+            if depth == 0:
+                return expr[i:j + 1], j + 1
+        j += 1
+    raise ValueError(f"unterminated interpolation at offset {i}")
+
+
+def tokenize_path(expr):
+    """Split .foo."bar.baz".${x}[0].*[*] into tokens ["foo", "bar.baz", "${x}", 0, ANY_ATTR, ANY_INDEX]"""
     tokens = []
-    for part in path.strip(".").split("."):
-        m = re.findall(r"([a-zA-Z0-9_-]+)|\[(\d+)\]", part)
-        for name, idx in m:
-            if name:
-                tokens.append(name)
-            elif idx:
-                tokens.append(int(idx))
-    return tokens
-
-
-def find_attr_binding(node, src, name):
-    """Return full binding node if found"""
-    for c in node.children:
-        if c.type == "binding":
-            key = c.child_by_field_name("name")
-            if key and src[key.start_byte:key.end_byte].decode() == name:
-                return c
-    return None
+    i = 0
+    n = len(expr)
+    while i < n:
+        c = expr[i]
+        if c == ".":
+            i += 1
+        elif c == "[":
+            end = expr.find("]", i)
+            if end == -1:
+                raise ValueError(f"unterminated index at offset {i}")
+            inner = expr[i + 1:end].strip()
+            if inner == "*":
+                tokens.append(ANY_INDEX)
+            elif inner.isdigit():
+                tokens.append(int(inner))
+            else:
+                raise ValueError(f"invalid index [{inner}] at offset {i}")
+            i = end + 1
+        elif c == '"':
+            name, i = _scan_quoted(expr, i)
+            tokens.append(name)
+        elif expr.startswith("${", i):
+            text, i = _scan_interpolation(expr, i)
+            tokens.append(text)
+        elif c == "*":
+            tokens.append(ANY_ATTR)
+            i += 1
+        else:
+            m = BARE_NAME.match(expr, i)
+            if not m:
+                raise ValueError(f"unexpected {c!r} at offset {i}")
+            tokens.append(m.group())
+            i = m.end()
+    return tuple(tokens)
+
+
+def format_path(tokens):
+    """Inverse of tokenize_path for concrete (wildcard free) tokens"""
+    out = []
+    for t in tokens:
+        if isinstance(t, int):
+            out.append(f"[{t}]")
+        elif BARE_NAME.fullmatch(t) or t.startswith("${"):
+            out.append(f".{t}")
+        else:
+            escaped = t.replace("\\", "\\\\").replace('"', '\\"')
+            out.append(f'."{escaped}"')
+    return "".join(out) or "."
+
 
+def attr_name(node, src):
+    """Return one attrpath component, with string quotes removed"""
+    text = src[node.start_byte:node.end_byte].decode()
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        return STRING_ESCAPE.sub(r"\1", text[1:-1])
+    return text
 
-def find_attr_value(node, src, name):
-    """Return value node inside attrset"""
-    b = find_attr_binding(node, src, name)
-    if b:
-        return b.child_by_field_name("value")
+
+def binding_names(binding, src):
+    """Return the attrpath of a binding as a tuple, e.g. ("a", "b") for a."b" = x;"""
+    key = binding.child_by_field_name("attrpath") or binding.child_by_field_name("name")
+    if key is None:
+        return None
+    parts = [c for c in key.children if c.is_named] or [key]
+    return tuple(attr_name(c, src) for c in parts)
+
+
+def binding_value(binding):
+    return binding.child_by_field_name("expression") or binding.child_by_field_name("value")
+
+
+def body(node):
+    """Skip the function header, let and parentheses around an attrset"""
+    while node is not None:
+        if node.type in {"source_code", "parenthesized_expression"}:
+            inner = [c for c in node.children if c.is_named and c.type != "comment"]
+            node = inner[0] if inner else None
+        elif node.type in {"function_expression", "let_expression", "with_expression"}:
+            node = node.child_by_field_name("body")
+        else:
+            return node
     return None
 
 
-def resolve_path(node, src, tokens):
-    """Walk path into the AST"""
-    cur = node
-    parent = None
-    key = None
-    for t in tokens:
-        if isinstance(t, str):  # attr
-            parent = cur
-            key = t
-            cur = find_attr_value(cur, src, t)
-            if cur is None:
-                return None, parent, key
-        elif isinstance(t, int):  # array index
-            if cur.type != "list_expression":
-                return None, parent, t
-            elems = [c for c in cur.children if c.type not in {"[", "]"}]
-            parent = cur
-            key = t
-            if t >= len(elems):
-                return None, parent, key
-            cur = elems[t]
-    return cur, parent, key
+def bindings(node, src):
+    """Yield (names, binding) for every binding directly inside node"""
+    for c in node.children:
+        if c.type == "binding_set":
+            yield from bindings(c, src)
+        elif c.type == "binding":
+            names = binding_names(c, src)
+            if names:
+                yield names, c
+
+
+def list_elements(node):
+    return [c for c in node.children if c.type not in {"[", "]"}]
+
+
+class CompiledPath:
+    """Tokenized path expression that can be matched against many trees"""
+
+    __slots__ = ("expr", "tokens", "has_wildcard")
+
+    def __init__(self, expr, tokens):
+        self.expr = expr
+        self.tokens = tokens
+        self.has_wildcard = any(isinstance(t, Wildcard) for t in tokens)
+
+    def __repr__(self):
+        return f"CompiledPath({self.expr!r})"
+
+    def matches(self, root, src):
+        """Yield (node, owner, key, concrete_tokens) for every match under root
+
+        owner is the binding holding node for attribute keys, and the list
+        holding it for indices.
+        """
+        yield from self._walk(root, src, 0, None, None, ())
+
+    def first(self, root, src):
+        """Return (node, owner, key) of the first match"""
+        for node, owner, key, _ in self.matches(root, src):
+            return node, owner, key
+        return None, None, None
+
+    def _walk(self, cur, src, i, owner, key, trail):
+        if i == len(self.tokens):
+            yield cur, owner, key, trail
+            return
+        t = self.tokens[i]
+        if t is ANY_ATTR or isinstance(t, str):
+            # a.b.c = x; consumes as many tokens as its attrpath has names
+            attrs = body(cur)
+            if attrs is None:
+                return
+            for names, b in bindings(attrs, src):
+                want = self.tokens[i:i + len(names)]
+                if len(want) < len(names) or not all(
+                    w is ANY_ATTR or w == n for w, n in zip(want, names)
+                ):
+                    continue
+                value = binding_value(b)
+                if value is not None:
+                    yield from self._walk(
+                        value, src, i + len(names), b, names[-1], trail + names
+                    )
+        elif cur.type == "list_expression":
+            elems = list_elements(cur)
+            if t is ANY_INDEX:
+                for idx, elem in enumerate(elems):
+                    yield from self._walk(elem, src, i + 1, cur, idx, trail + (idx,))
+            elif t < len(elems):
+                yield from self._walk(elems[t], src, i + 1, cur, t, trail + (t,))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_path(expr):
+    """Compile a path expression once; repeated calls return the cached matcher"""
+    return CompiledPath(expr, tokenize_path(expr))
+
+
+def compile_or_exit(expr):
+    try:
+        return compile_path(expr)
+    except ValueError as e:
+        sys.exit(f"Invalid path {expr}: {e}")
+
+
+def replace_spans(code, spans):
+    """Apply (start, end, replacement) edits back to front so offsets stay valid"""
+    for start, end, repl in sorted(spans, reverse=True):
+        code = code[:start] + repl + code[end:]
+    return code
 
 
 def get(path, expr):
     code, tree = parse_file(path)
-    tokens = split_path(expr)
-    val, _, _ = resolve_path(tree.root_node, code, tokens)
-    if not val:
+    matcher = compile_or_exit(expr)
+    found = False
+    for val, _, _, _ in matcher.matches(tree.root_node, code):
+        found = True
+        print(code[val.start_byte:val.end_byte].decode())
+    if not found:
+        sys.exit(f"Path {expr} not found")
+
+
+def query(expr, paths):
+    """Print every match of expr in each file, prefixed with its concrete path"""
+    matcher = compile_or_exit(expr)
+    found = False
+    for path in paths:
+        code, tree = parse_file(path)
+        prefix = f"{path}:" if len(paths) > 1 else ""
+        for val, _, _, trail in matcher.matches(tree.root_node, code):
+            found = True
+            text = code[val.start_byte:val.end_byte].decode()
+            print(f"{prefix}{format_path(trail)} = {text}")
+    if not found:
         sys.exit(f"Path {expr} not found")
-    print(code[val.start_byte:val.end_byte].decode())
 
 
 def setval(path, expr, newval):
     code, tree = parse_file(path)
-    tokens = split_path(expr)
+    matcher = compile_or_exit(expr)
 
-    val, _, _ = resolve_path(tree.root_node, code, tokens)
-    if not val:
+    targets = [val for val, _, _, _ in matcher.matches(tree.root_node, code)]
+    if not targets:
         sys.exit(f"Path {expr} not found (creation not shown in delete version)")
 
     if not (newval.startswith('"') or newval in ["true", "false"] or newval.isdigit()):
         newval = f"\"{newval}\""
 
-    new_code = code[:val.start_byte] + newval.encode() + code[val.end_byte:]
+    new_code = replace_spans(
+        code, [(val.start_byte, val.end_byte, newval.encode()) for val in targets]
+    )
     with open(path, "wb") as f:
         f.write(new_code)
 
 
 def delete(path, expr):
     code, tree = parse_file(path)
-    tokens = split_path(expr)
-    node, parent, key = resolve_path(tree.root_node, code, tokens)
-    if not node:
-        sys.exit(f"Path {expr} not found")
-
-    if isinstance(key, str):  # deleting attr binding
-        b = find_attr_binding(parent, code, key)
-        if not b:
-            sys.exit("Could not resolve binding for deletion")
-        start, end = b.start_byte, b.end_byte
-    elif isinstance(key, int):  # deleting array element
-        elems = [c for c in parent.children if c.type not in {"[", "]"}]
-        target = elems[key]
-        start, end = target.start_byte, target.end_byte
-    else:
+    matcher = compile_or_exit(expr)
+    if not matcher.tokens:
         sys.exit("Invalid delete target")
 
-    new_code = code[:start] + code[end:]
+    spans = []
+    for val, owner, key, _ in matcher.matches(tree.root_node, code):
+        if isinstance(key, str):  # deleting attr binding
+            spans.append((owner.start_byte, owner.end_byte, b""))
+        else:  # deleting array element
+            spans.append((val.start_byte, val.end_byte, b""))
+    if not spans:
+        sys.exit(f"Path {expr} not found")
+
+    new_code = replace_spans(code, spans)
     with open(path, "wb") as f:
         f.write(new_code)
 
 
 def main():
+    # Plain --help is answered without argparse, which costs more to import
+    # than the rest of the script
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(__doc__.strip())
+        return
+
+    import argparse
+
     p = argparse.ArgumentParser()
     sub = p.add_subparsers(dest="cmd")
 
@@ -127,6 +338,10 @@ def main():
     g.add_argument("file")
     g.add_argument("expr")
 
+    q = sub.add_parser("query")
+    q.add_argument("expr")
+    q.add_argument("files", nargs="+")
+
     s = sub.add_parser("set")
     s.add_argument("file")
     s.add_argument("expr")
@@ -139,6 +354,8 @@ def main():
     args = p.parse_args()
     if args.cmd == "get":
         get(args.file, args.expr)
+    elif args.cmd == "query":
+        query(args.expr, args.files)
     elif args.cmd == "set":
         setval(args.file, args.expr, args.value)
     elif args.cmd == "del":
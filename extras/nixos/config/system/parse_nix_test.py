@@ -0,0 +1,203 @@
+# parse_nix_test.py
+#
+# Path expressions and matching for parse-nix.py. The matcher only needs
+# .type/.children/byte offsets from a node, so a small stand-in for
+# tree_sitter nodes is enough and these run without the nix grammar.
+
+from pathlib import Path
+import importlib.util
+import re
+
+import pytest
+
+PARSE_NIX = Path(__file__).resolve().parent / "parse-nix.py"
+
+spec = importlib.util.spec_from_file_location("parse_nix", PARSE_NIX)
+parse_nix = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(parse_nix)
+
+ANY_ATTR = parse_nix.ANY_ATTR
+ANY_INDEX = parse_nix.ANY_INDEX
+
+
+class Node:
+    def __init__(self, type, src, text, children=(), fields=None, named=True):
+        self.type = type
+        self.start_byte = src.index(text.encode())
+        self.end_byte = self.start_byte + len(text.encode())
+        self.children = list(children)
+        self.fields = fields or {}
+        self.is_named = named
+
+    def child_by_field_name(self, name):
+        return self.fields.get(name)
+
+
+def attrset(src, text, *bindings):
+    return Node(
+        "attrset_expression",
+        src,
+        text,
+        [Node("binding_set", src, text.strip("{} "), bindings)],
+    )
+
+
+def binding(src, text, names, value):
+    """binding(src, 'a."b" = 1;', ['a', '"b"'], value_node)"""
+    path = Node(
+        "attrpath",
+        src,
+        text.split(" =")[0],
+        [Node("identifier", src, n) for n in names],
+    )
+    fields = {"attrpath": path, "expression": value}
+    return Node("binding", src, text, [path, value], fields)
+
+
+SRC = b"""{
+  services.openssh.enable = true;
+  security.pam.services.gdm.enableGnomeKeyring = true;
+  services.xserver = { enable = false; };
+  "a.b"."c" = 1;
+  list = [ 4 5 ];
+}"""
+
+
+@pytest.fixture
+def root():
+    true = Node("variable_expression", SRC, "true")
+    false = Node("variable_expression", SRC, "false")
+    one = Node("integer_expression", SRC, "1")
+    four = Node("integer_expression", SRC, "4")
+    five = Node("integer_expression", SRC, "5")
+    return Node(
+        "source_code",
+        SRC,
+        SRC.decode(),
+        [
+            attrset(
+                SRC,
+                SRC.decode(),
+                binding(
+                    SRC,
+                    "services.openssh.enable = true;",
+                    ["services", "openssh", "enable"],
+                    true,
+                ),
+                binding(
+                    SRC,
+                    "security.pam.services.gdm.enableGnomeKeyring = true;",
+                    ["security", "pam", "services", "gdm", "enableGnomeKeyring"],
+                    true,
+                ),
+                binding(
+                    SRC,
+                    "services.xserver = { enable = false; };",
+                    ["services", "xserver"],
+                    attrset(
+                        SRC,
+                        "{ enable = false; }",
+                        binding(SRC, "enable = false;", ["enable"], false),
+                    ),
+                ),
+                binding(SRC, '"a.b"."c" = 1;', ['"a.b"', '"c"'], one),
+                binding(
+                    SRC,
+                    "list = [ 4 5 ];",
+                    ["list"],
+                    Node("list_expression", SRC, "[ 4 5 ]", [
+                        Node("[", SRC, "[", named=False),
+                        four,
+                        five,
+                        Node("]", SRC, "]", named=False),
+                    ]),
+                ),
+            )
+        ],
+    )
+
+
+def query(root, expr):
+    matcher = parse_nix.compile_path(expr)
+    return [
+        (parse_nix.format_path(trail), SRC[val.start_byte:val.end_byte].decode())
+        for val, _, _, trail in matcher.matches(root, SRC)
+    ]
+
+
+@pytest.mark.parametrize(
+    "expr, tokens",
+    [
+        ("services.openssh.enable", ("services", "openssh", "enable")),
+        (".a.b", ("a", "b")),
+        ('"a.b".c', ("a.b", "c")),
+        ('"say \\"hi\\""', ('say "hi"',)),
+        ("${name}.enable", ("${name}", "enable")),
+        ('${lib.concat "a" "}"}.x', ('${lib.concat "a" "}"}', "x")),
+        ("list[0][12]", ("list", 0, 12)),
+        ("services.*.enable", ("services", ANY_ATTR, "enable")),
+        ("list[*]", ("list", ANY_INDEX)),
+    ],
+)
+def test_tokenize_path(expr, tokens):
+    assert parse_nix.tokenize_path(expr) == tokens
+
+
+@pytest.mark.parametrize(
+    "expr, message",
+    [
+        ("a.b]", "unexpected ']' at offset 3"),
+        ("a.[x]", "invalid index [x] at offset 2"),
+        ("a!", "unexpected '!' at offset 1"),
+        ('"abc', "unterminated"),
+        ("${abc", "unterminated"),
+    ],
+)
+def test_tokenize_path_errors(expr, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        parse_nix.tokenize_path(expr)
+
+
+@pytest.mark.parametrize(
+    "expr",
+    ["services.openssh.enable", '"a.b".c', "${name}.x", "list[0]", "a[1].b"],
+)
+def test_format_path_round_trips(expr):
+    tokens = parse_nix.tokenize_path(expr)
+    assert parse_nix.tokenize_path(parse_nix.format_path(tokens)) == tokens
+
+
+def test_compile_path_is_memoized():
+    assert parse_nix.compile_path("a.*.b") is parse_nix.compile_path("a.*.b")
+    assert parse_nix.compile_path("a.*.b").has_wildcard
+    assert not parse_nix.compile_path("a.b").has_wildcard
+
+
+def test_dotted_bindings_match_per_component(root):
+    assert query(root, "services.*.enable") == [
+        (".services.openssh.enable", "true"),
+        (".services.xserver.enable", "false"),
+    ]
+    assert query(root, "security.pam.services.gdm.enableGnomeKeyring") == [
+        (".security.pam.services.gdm.enableGnomeKeyring", "true"),
+    ]
+    # a prefix of a dotted binding has no node of its own
+    assert query(root, "services.openssh") == []
+
+
+def test_quoted_components_are_unquoted(root):
+    assert query(root, '"a.b".c') == [('."a.b".c', "1")]
+    assert query(root, "a.b.c") == []
+
+
+def test_index_wildcard(root):
+    assert query(root, "list[*]") == [(".list[0]", "4"), (".list[1]", "5")]
+    assert query(root, "list[1]") == [(".list[1]", "5")]
+
+
+def test_match_owner_is_the_binding(root):
+    matcher = parse_nix.compile_path("services.openssh.enable")
+    _, owner, key = matcher.first(root, SRC)
+    assert key == "enable"
+    assert SRC[owner.start_byte:owner.end_byte] == b"services.openssh.enable = true;"
+
@@ -1,12 +1,134 @@
 # type: ignore
 
-import questionary
+"""Collect template data for tt and write it as YAML.
+
+Answers come from, in order of precedence: --set key=value flags, the
+--answers file, Q_<FIELD> environment variables (e.g. Q_AUTHOR), and
+finally an interactive prompt for whatever is still missing. Prompts
+default to the previous run's answers; without a terminal (or with
+--no-input) those answers are reused as they are.
+
+An answers file holding a list of mappings generates one output per entry;
+--output may use {index} and any field, e.g. "hosts/{hostname}.yaml".
+"""
+
+import argparse
+import os
+import sys
+
 import yaml
 
-answers = {
-    "project-description": questionary.text("Project description?").ask(),
-    "author": questionary.text("Author?").ask(),
+FIELDS = {
+    "project-description": "Project description?",
+    "author": "Author?",
 }
 
-with open("data.yaml", "w") as f:
-    yaml.dump(answers, f)
+STATE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "tt-q-answers.yaml",
+)
+
+
+def load_yaml(path, default, missing_ok=False):
+    try:
+        with open(path) as f:
+            data = yaml.safe_load(f)
+    except FileNotFoundError:
+        if missing_ok:
+            return default
+        sys.exit(f"No such file: {path}")
+    return default if data is None else data
+
+
+def from_env():
+    answers = {}
+    for field in FIELDS:
+        value = os.environ.get("Q_" + field.upper().replace("-", "_"))
+        if value is not None:
+            answers[field] = value
+    return answers
+
+
+def from_flags(pairs):
+    answers = {}
+    for pair in pairs:
+        key, sep, value = pair.partition("=")
+        if not sep:
+            sys.exit(f"Invalid --set {pair!r}, expected key=value")
+        answers[key] = value
+    return answers
+
+
+def complete(answers, previous, interactive):
+    """Prompt for missing fields, defaulting to the previous answers"""
+    missing = [field for field in FIELDS if field not in answers]
+    if missing and not interactive:
+        for field in missing:
+            if field not in previous:
+                sys.exit(f"Missing answer for {field} and nothing to reuse")
+            answers[field] = previous[field]
+        return answers
+    if missing:
+        # questionary is slow to import and only needed when prompting
+        import questionary
+
+        for field in missing:
+            answer = questionary.text(
+                FIELDS[field], default=str(previous.get(field, ""))
+            ).ask()
+            if answer is None:  # Ctrl-C
+                sys.exit(1)
+            answers[field] = answer
+    return answers
+
+
+def output_path(output, index, answers):
+    try:
+        return output.format_map({**answers, "index": index})
+    except KeyError as e:
+        sys.exit(f"--output {output!r} uses {{{e.args[0]}}}, which is not a field")
+    except (IndexError, ValueError) as e:
+        sys.exit(f"Invalid --output {output!r}: {e}")
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-a", "--answers", help="YAML mapping, or list of mappings")
+    p.add_argument("-s", "--set", action="append", default=[], metavar="KEY=VALUE")
+    p.add_argument("-o", "--output", help="output path (default data.yaml)")
+    p.add_argument("-n", "--no-input", action="store_true", help="never prompt")
+    args = p.parse_args(argv)
+
+    entries = load_yaml(args.answers, {}) if args.answers else {}
+    batch = isinstance(entries, list)
+    if not batch:
+        entries = [entries]
+    if not all(isinstance(entry, dict) for entry in entries):
+        sys.exit(f"{args.answers} must hold a mapping or a list of mappings")
+    output = args.output or ("data-{index}.yaml" if batch else "data.yaml")
+
+    previous = load_yaml(STATE_FILE, {}, missing_ok=True)
+    env = from_env()
+    flags = from_flags(args.set)
+    interactive = not args.no_input and sys.stdin.isatty()
+
+    # Resolve every entry before writing any, so an error leaves nothing half done
+    outputs = []
+    for index, entry in enumerate(entries):
+        answers = complete({**env, **entry, **flags}, previous, interactive)
+        outputs.append((output_path(output, index, answers), answers))
+        previous = answers
+
+    for path, answers in outputs:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            yaml.dump(answers, f)
+        print(f"Wrote {path}")
+
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE, "w") as f:
+        yaml.dump(previous, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# q_test.py
+#
+# Answer precedence, reuse of previous answers and batch output for q.py.
+# stdin is not a terminal under pytest, so q.py never prompts here.
+
+import pytest
+import yaml
+
+import q
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(q, "STATE_FILE", str(tmp_path / "cache" / "answers.yaml"))
+    for field in q.FIELDS:
+        monkeypatch.delenv("Q_" + field.upper().replace("-", "_"), raising=False)
+    return tmp_path
+
+
+def write(path, data):
+    with open(path, "w") as f:
+        yaml.dump(data, f)
+
+
+def read(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+def test_flags_beat_file_beat_env_beat_previous(monkeypatch):
+    q.main(["-s", "author=previous", "-s", "project-description=previous"])
+
+    monkeypatch.setenv("Q_AUTHOR", "env")
+    monkeypatch.setenv("Q_PROJECT_DESCRIPTION", "env")
+    write("answers.yaml", {"author": "file"})
+    q.main(["-a", "answers.yaml", "-o", "file.yaml"])
+    assert read("file.yaml") == {"author": "file", "project-description": "env"}
+
+    q.main(["-a", "answers.yaml", "-s", "author=flag", "-o", "flag.yaml"])
+    assert read("flag.yaml")["author"] == "flag"
+
+
+def test_no_input_reuses_previous_answers():
+    q.main(["-s", "author=me", "-s", "project-description=demo"])
+    q.main(["-n", "-s", "author=you", "-o", "again.yaml"])
+    assert read("again.yaml") == {"author": "you", "project-description": "demo"}
+
+
+def test_no_input_without_previous_answers_fails():
+    with pytest.raises(SystemExit, match="Missing answer for"):
+        q.main(["-n", "-s", "author=me"])
+
+
+def test_batch_writes_one_file_per_entry():
+    write("hosts.yaml", [
+        {"author": "a", "project-description": "x", "hostname": "laptop"},
+        {"author": "b", "project-description": "y", "hostname": "server", "index": 7},
+    ])
+    q.main(["-a", "hosts.yaml", "-o", "out/{index}-{hostname}.yaml"])
+    assert read("out/0-laptop.yaml")["author"] == "a"
+    assert read("out/1-server.yaml")["index"] == 7
+    assert read(q.STATE_FILE)["author"] == "b"
+
+
+def test_batch_writes_nothing_when_an_entry_fails(workdir):
+    write("hosts.yaml", [
+        {"author": "a", "project-description": "x", "hostname": "laptop"},
+        {"author": "b", "project-description": "y"},
+    ])
+    with pytest.raises(SystemExit, match="uses {hostname}"):
+        q.main(["-a", "hosts.yaml", "-o", "{hostname}.yaml"])
+    assert not (workdir / "laptop.yaml").exists()
+
+
+@pytest.mark.parametrize("data", ["foo", ["foo"], [{"author": "a"}, 3]])
+def test_answers_must_be_mappings(data):
+    write("answers.yaml", data)
+    with pytest.raises(SystemExit, match="must hold a mapping"):
+        q.main(["-a", "answers.yaml"])
+
+
+def test_missing_answers_file_fails():
+    with pytest.raises(SystemExit, match="No such file: typo.yaml"):
+        q.main(["-a", "typo.yaml"])
@@ -1,5 +1,220 @@
-def main():
-    print("Hello from stow!")
+#!/usr/bin/env python3
+
+# Installs every package of a host's profile with the pystow engine in a
+# single process, instead of running stow once per package.
+from __future__ import annotations
+
+import os
+import sys
+
+from pystow import link_packages, stow_dir
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from pathlib import Path
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROFILES_FILE = os.path.join(HERE, "profiles.toml")
+CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "pystow",
+    "profiles.json",
+)
+
+
+def load_profiles(path: str) -> dict:
+    """
+    Reads a profiles file: [profiles.<name>] tables with `packages` and
+    optional `extends` lists, and a [hosts] table mapping hostnames to
+    profile names.
+    """
+    import tomllib
+
+    try:
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        print(f"Error: Could not read profiles '{path}'. {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def resolve_profile(profiles: dict, name: str, seen: tuple[str, ...] = ()) -> list[str]:
+    """
+    Returns the packages of a profile, including those of the profiles it
+    extends (first), without duplicates.
+
+    Examples:
+      default = ["git"], hypr = {extends: ["default"], packages: ["hypr"]}
+      resolve_profile(profiles, "hypr") -> ["git", "hypr"]
+    """
+    if name in seen:
+        raise ValueError(f"profile cycle: {' -> '.join(seen + (name,))}")
+    if name not in profiles:
+        raise ValueError(f"unknown profile '{name}'")
+
+    packages: list[str] = []
+    profile = profiles[name]
+    for parent in profile.get("extends", []):
+        packages += resolve_profile(profiles, parent, seen + (name,))
+    packages += profile.get("packages", [])
+    return list(dict.fromkeys(packages))
+
+
+def host_packages(path: str, host: str, profile: str | None) -> tuple[str, list[str]]:
+    """
+    Resolves (profile name, packages) for host. The result is cached on disk
+    per host and reused until the profiles file changes.
+    """
+    import json
+
+    mtime = os.stat(path).st_mtime_ns
+    key = f"{host}:{profile or ''}"
+    try:
+        with open(CACHE_FILE, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    entry = cache.get(key)
+    if entry and entry["path"] == path and entry["mtime"] == mtime:
+        return entry["profile"], entry["packages"]
+
+    config = load_profiles(path)
+    name = profile or config.get("hosts", {}).get(host, "default")
+    try:
+        packages = resolve_profile(config.get("profiles", {}), name)
+    except ValueError as e:
+        print(f"Error: {e} in '{path}'", file=sys.stderr)
+        sys.exit(1)
+
+    cache[key] = {"path": path, "mtime": mtime, "profile": name, "packages": packages}
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Warning: Could not write cache '{CACHE_FILE}': {e}")
+    return name, packages
+
+
+def install(
+    repo: Path,
+    target: Path,
+    packages: list[str],
+    force: bool,
+    dry_run: bool,
+    verbose: bool,
+) -> None:
+    """
+    Links all packages from repo into target at once, exiting on failure.
+    """
+    repo = repo.resolve()
+    target = target.resolve()
+    missing = [name for name in packages if not (repo / name).is_dir()]
+    if missing:
+        print(
+            f"Error: Packages not found in '{repo}': {', '.join(missing)}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    if not target.is_dir():
+        print(f"Error: Target directory not found at '{target}'", file=sys.stderr)
+        sys.exit(1)
+
+    if dry_run:
+        print("--- DRY RUN MODE: No changes will be made. ---")
+
+    try:
+        link_packages(
+            [repo / name for name in packages], target, force, dry_run, verbose
+        )
+    except (FileExistsError, OSError) as e:
+        print(f"\nOperation failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print("\n✨ Done.")
+
+
+def main() -> None:
+    import argparse
+    from pathlib import Path
+    import socket
+
+    parser = argparse.ArgumentParser(
+        description="Link every package of this host's profile into the target.",
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog="""
+Example Usage:
+  # Install the profile mapped to this hostname (or "default")
+  python main.py
+
+  # Install the hypr profile, showing what would happen
+  python main.py --profile hypr --dry-run
+
+  # Link a single source directory, like pystow.py
+  python main.py ~/dotfiles/git ~
+""",
+    )
+    parser.add_argument(
+        "dirs",
+        nargs="*",
+        type=Path,
+        metavar="SOURCE_DIR TARGET_DIR",
+        help="Stow a single directory instead of a profile.",
+    )
+    parser.add_argument("-p", "--profile", help="Profile to install.")
+    parser.add_argument(
+        "--host", default=socket.gethostname(), help="Host to resolve the profile for."
+    )
+    parser.add_argument("--profiles", default=PROFILES_FILE, help="Profiles file.")
+    parser.add_argument(
+        "--repo",
+        type=Path,
+        default=Path(os.environ.get("DOT_DIR") or Path(HERE).parent.parent),
+        help="Directory containing the packages (default: $DOT_DIR or this repo).",
+    )
+    parser.add_argument(
+        "-t", "--target", type=Path, default=Path.home(), help="Target directory."
+    )
+    parser.add_argument(
+        "-l", "--list", action="store_true", help="Print the packages and exit."
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="If a target file/dir exists, move it to a .bak file before linking.",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Show what would be done without making any changes.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose output."
+    )
+
+    args = parser.parse_args()
+
+    if args.dirs:
+        if len(args.dirs) != 2:
+            parser.error("expected SOURCE_DIR and TARGET_DIR")
+        stow_dir(args.dirs[0], args.dirs[1], args.force, args.dry_run, args.verbose)
+        return
+
+    profiles = os.path.abspath(args.profiles)
+    name, packages = host_packages(profiles, args.host, args.profile)
+
+    if args.list:
+        print("\n".join(packages))
+        return
+
+    print(f"Profile: {name} (host {args.host})")
+    print(f"Packages: {' '.join(packages)}")
+    print(f"Target: {args.target}\n")
+    install(args.repo, args.target, packages, args.force, args.dry_run, args.verbose)
 
 
 if __name__ == "__main__":
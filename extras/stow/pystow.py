@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
-import argparse
-from datetime import datetime
+# argparse, datetime and pathlib are imported where they are used so that
+# importing this module (e.g. from login hooks) stays cheap.
+from __future__ import annotations
+
 import functools
 import os
-from pathlib import Path
 import sys
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from pathlib import Path
+
 DEFAULT_IGNORES: set[str] = {
     ".git",
     ".gitignore",
@@ -104,6 +109,9 @@ def create_backup(target_path: Path, dry_run: bool, verbose: bool) -> None:
     """
     Moves a file or directory to a timestamped backup location.
     """
+    from datetime import datetime
+    from pathlib import Path
+
     timestamp = datetime.now().strftime("%Y-%m-%dT%H%M%S")
     backup_path = Path(f"{target_path}.bak.{timestamp}")
 
@@ -169,10 +177,113 @@ def link_package(
             raise
 
 
+def link_packages(
+    packages: list[Path], target_dir: Path, force: bool, dry_run: bool, verbose: bool
+) -> None:
+    """
+    Links the contents of several packages into target_dir in one pass.
+
+    An entry provided by only one package is linked whole, as link_package
+    does. A directory provided by several packages, or one that already
+    exists as a real directory in the target, is created as a real directory
+    instead and the packages' contents are linked inside it, recursively.
+    """
+    entries: dict[str, list[Path]] = {}
+    for package in packages:
+        for item in sorted(package.iterdir()):
+            if item.name in IGNORED_ITEMS or should_ignore_file(item, package):
+                if verbose:
+                    print(f"Ignoring [ {item} ]")
+                continue
+            entries.setdefault(replace_dot(item.name), []).append(item)
+
+    for name, sources in sorted(entries.items()):
+        target_path = target_dir / name
+        shared = len(sources) > 1
+        real_dir = target_path.is_dir() and not target_path.is_symlink()
+
+        merge = all(source.is_dir() for source in sources) and (shared or real_dir)
+        if not merge:
+            if shared:
+                others = ", ".join(str(source) for source in sources)
+                print(
+                    f"Error: '{target_path}' is provided by several packages: {others}",
+                    file=sys.stderr,
+                )
+                raise FileExistsError(f"Package conflict at {target_path}")
+            link_package(sources[0], target_dir, force, dry_run, verbose)
+            continue
+
+        if not real_dir:
+            if target_path.exists() or target_path.is_symlink():
+                if not force:
+                    print(
+                        f"Error: Target '{target_path}' already exists. Use --force to overwrite.",  # noqa: E501
+                        file=sys.stderr,
+                    )
+                    raise FileExistsError(f"Target conflict at {target_path}")
+                create_backup(target_path, dry_run, verbose)
+            action = "Would create" if dry_run else "Creating"
+            print(f"  - {action} directory [ {target_path} ]")
+            if not dry_run:
+                target_path.mkdir(parents=True)
+
+        link_packages(sources, target_path, force, dry_run, verbose)
+
+
+def stow_dir(
+    source_dir: Path, target_dir: Path, force: bool, dry_run: bool, verbose: bool
+) -> None:
+    """
+    Validates the directories and links every item of source_dir into
+    target_dir, exiting with an error message on failure.
+    """
+    if not source_dir.is_dir():
+        print(f"Error: Source directory not found at '{source_dir}'", file=sys.stderr)
+        sys.exit(1)
+
+    if not target_dir.is_dir():
+        print(f"Error: Target directory not found at '{target_dir}'", file=sys.stderr)
+        sys.exit(1)
+
+    source_dir = source_dir.resolve()
+    target_dir = target_dir.resolve()
+
+    if source_dir == target_dir:
+        print(
+            "Error: Source and target directories cannot be the same.", file=sys.stderr
+        )
+        sys.exit(1)
+
+    if dry_run:
+        print("--- DRY RUN MODE: No changes will be made. ---")
+
+    print(f"Source: {source_dir}")
+    print(f"Target: {target_dir}\n")
+
+    packages_to_link: list[Path] = list(source_dir.iterdir())
+
+    if not packages_to_link:
+        print("Source directory is empty. Nothing to do.")
+        sys.exit(0)
+
+    try:
+        for package_path in sorted(packages_to_link):
+            link_package(package_path, target_dir, force, dry_run, verbose)
+    except (FileExistsError, OSError) as e:
+        print(f"\nOperation failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print("\n✨ Done.")
+
+
 def stow() -> None:
     """
     Main function to parse arguments and orchestrate the stowing process.
     """
+    import argparse
+    from pathlib import Path
+
     parser = argparse.ArgumentParser(
         description="A simple stow-like utility to link dotfiles.",
         formatter_class=argparse.RawTextHelpFormatter,
@@ -215,50 +326,7 @@ Example Usage:
     )
 
     args = parser.parse_args()
-
-    if not args.source_dir.is_dir():
-        print(
-            f"Error: Source directory not found at '{args.source_dir}'", file=sys.stderr
-        )
-        sys.exit(1)
-
-    if not args.target_dir.is_dir():
-        print(
-            f"Error: Target directory not found at '{args.target_dir}'", file=sys.stderr
-        )
-        sys.exit(1)
-
-    source_dir = args.source_dir.resolve()
-    target_dir = args.target_dir.resolve()
-
-    if source_dir == target_dir:
-        print(
-            "Error: Source and target directories cannot be the same.", file=sys.stderr
-        )
-        sys.exit(1)
-
-    if args.dry_run:
-        print("--- DRY RUN MODE: No changes will be made. ---")
-
-    print(f"Source: {source_dir}")
-    print(f"Target: {target_dir}\n")
-
-    packages_to_link: list[Path] = list(source_dir.iterdir())
-
-    if not packages_to_link:
-        print("Source directory is empty. Nothing to do.")
-        sys.exit(0)
-
-    try:
-        for package_path in sorted(packages_to_link):
-            link_package(
-                package_path, target_dir, args.force, args.dry_run, args.verbose
-            )
-    except (FileExistsError, OSError) as e:
-        print(f"\nOperation failed: {e}", file=sys.stderr)
-        sys.exit(1)
-
-    print("\n✨ Done.")
+    stow_dir(args.source_dir, args.target_dir, args.force, args.dry_run, args.verbose)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 
 from collections.abc import Generator
 from pathlib import Path
+import os
 import sys
 from typing import Any
 
@@ -9,8 +10,8 @@ from _pytest.capture import CaptureFixture
 from _pytest.monkeypatch import MonkeyPatch
 import pytest
 
-from main import main
-from pystow import get_ignore_patterns, replace_dot, should_ignore_file
+from main import main, resolve_profile
+from pystow import get_ignore_patterns, link_packages, replace_dot, should_ignore_file
 
 
 def demonstrate_ignore_logic():
@@ -361,3 +362,94 @@ def test_invalid_args_nonexistent_dir(
     )
     assert exit_code != 0
     assert "Target directory not found" in err
+
+
+# --- Tests for Profile Installs ---
+
+
+def test_resolve_profile_extends_without_duplicates():
+    """Tests that extended profiles come first and packages are not repeated."""
+    profiles = {
+        "default": {"packages": ["git", "tmux"]},
+        "wayland": {"extends": ["default"], "packages": ["foot", "git"]},
+        "hypr": {"extends": ["wayland", "default"], "packages": ["hypr"]},
+    }
+
+    assert resolve_profile(profiles, "hypr") == ["git", "tmux", "foot", "hypr"]
+
+    with pytest.raises(ValueError):
+        resolve_profile({"a": {"extends": ["b"]}, "b": {"extends": ["a"]}}, "a")
+
+
+def test_link_packages_merges_shared_directories(fs_setup: tuple[Path, Path]):
+    """Test that a directory shared by packages is created and its contents linked."""
+    source_dir, target_dir = fs_setup
+    for package in ("hypr", "foot"):
+        (source_dir / package / "dot-config" / package).mkdir(parents=True)
+    (source_dir / "git").mkdir()
+    (source_dir / "git" / "dot-gitconfig").touch()
+
+    link_packages(
+        [source_dir / name for name in ("hypr", "foot", "git")],
+        target_dir,
+        force=False,
+        dry_run=False,
+        verbose=False,
+    )
+
+    config = target_dir / ".config"
+    assert config.is_dir() and not config.is_symlink()
+    assert (config / "hypr").resolve() == (source_dir / "hypr/dot-config/hypr").resolve()
+    assert (config / "foot").resolve() == (source_dir / "foot/dot-config/foot").resolve()
+    assert (target_dir / ".gitconfig").is_symlink()
+
+
+def test_install_profile(
+    fs_setup: tuple[Path, Path], monkeypatch: MonkeyPatch, capsys: CaptureFixture[str]
+):
+    """Test installing a profile from a profiles file in one run."""
+    source_dir, target_dir = fs_setup
+    (source_dir / "git").mkdir()
+    (source_dir / "git" / "dot-gitconfig").touch()
+    (source_dir / "niri" / "dot-config" / "niri").mkdir(parents=True)
+    profiles = source_dir.parent / "profiles.toml"
+    profiles.write_text(
+        '[profiles.default]\npackages = ["git"]\n\n'
+        '[profiles.niri]\nextends = ["default"]\npackages = ["niri"]\n\n'
+        '[hosts]\nlaptop = "niri"\n'
+    )
+    monkeypatch.setattr("main.CACHE_FILE", str(source_dir.parent / "cache.json"))
+    (target_dir / ".config").mkdir()  # existing real directories are kept
+
+    args = ["--host", "laptop", "--profiles", str(profiles)]
+    args += ["--repo", str(source_dir), "--target", str(target_dir)]
+    exit_code, out, err = run_pystow(monkeypatch, capsys, args)
+
+    assert exit_code == 0
+    assert err == ""
+    assert "Profile: niri" in out
+    assert (target_dir / ".gitconfig").is_symlink()
+    assert (target_dir / ".config" / "niri").is_symlink()
+
+
+def test_install_profile_relative_repo(
+    fs_setup: tuple[Path, Path], monkeypatch: MonkeyPatch, capsys: CaptureFixture[str]
+):
+    """Test that a relative --repo still produces absolute, working links."""
+    source_dir, target_dir = fs_setup
+    (source_dir / "git").mkdir()
+    (source_dir / "git" / "dot-gitconfig").touch()
+    profiles = source_dir.parent / "profiles.toml"
+    profiles.write_text('[profiles.default]\npackages = ["git"]\n')
+    monkeypatch.setattr("main.CACHE_FILE", str(source_dir.parent / "cache.json"))
+    monkeypatch.chdir(source_dir.parent)
+
+    args = ["--profiles", str(profiles), "--repo", source_dir.name]
+    args += ["--target", str(target_dir)]
+    exit_code, _, err = run_pystow(monkeypatch, capsys, args)
+
+    link = target_dir / ".gitconfig"
+    assert exit_code == 0
+    assert err == ""
+    assert Path(os.readlink(link)).is_absolute()
+    assert link.resolve() == (source_dir / "git" / "dot-gitconfig").resolve()
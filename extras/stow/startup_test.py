@@ -0,0 +1,76 @@
+# startup_test.py
+#
+# Cold-start budgets for the Python helper scripts, measured with
+# `python -X importtime`. These scripts run from login hooks and bars, so
+# new top-level imports should be deferred to where they are used. The
+# budgets leave room for slow machines; the forbidden modules are what
+# catches an eager import.
+
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+HERE = Path(__file__).resolve().parent
+PARSE_NIX = HERE.parent / "nixos" / "config" / "system" / "parse-nix.py"
+
+RUNS = 3
+
+
+def import_times(args: list[str], cwd: Path) -> dict[str, tuple[int, bool]]:
+    """
+    Runs python with -X importtime and returns, for every imported module,
+    its cumulative import time in microseconds and whether it was imported
+    at top level (rather than nested inside another import).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        # A script that dies on a missing module must not pass as "lazy"
+        check=True,
+    )
+    times: dict[str, tuple[int, bool]] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = (int(cumulative), not name.startswith("  "))
+    return times
+
+
+def startup_cost(args: list[str], cwd: Path) -> tuple[float, set[str]]:
+    """
+    Returns (best import time in ms over RUNS runs, modules imported) for
+    args, excluding whatever a bare interpreter imports on its own.
+    """
+    baseline = set(import_times(["-c", "pass"], cwd))
+    best = None
+    modules: set[str] = set()
+    for _ in range(RUNS):
+        times = import_times(args, cwd)
+        modules = set(times) - baseline
+        total = sum(times[name][0] for name in modules if times[name][1]) / 1000
+        best = total if best is None else min(best, total)
+    return best or 0.0, modules
+
+
+@pytest.mark.parametrize(
+    "args, budget_ms, forbidden",
+    [
+        (["-c", "import pystow"], 25, {"argparse", "datetime", "pathlib"}),
+        (["-c", "import main"], 25, {"argparse", "datetime", "json", "tomllib"}),
+        ([str(PARSE_NIX), "--help"], 25, {"argparse", "tree_sitter"}),
+    ],
+    ids=["pystow", "main", "parse-nix --help"],
+)
+def test_startup_budget(args: list[str], budget_ms: int, forbidden: set[str]):
+    """Checks that a script stays within its import budget and lazy imports."""
+    cost, modules = startup_cost(args, HERE)
+
+    assert not modules & forbidden, f"eagerly imports {modules & forbidden}"
+    assert cost <= budget_ms, f"imports took {cost:.1f}ms (budget {budget_ms}ms)"